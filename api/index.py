@@ -1,55 +1,242 @@
+import asyncio
+import hmac
 import os
-from fastapi import FastAPI, HTTPException, Header, Depends
-from pydantic import BaseModel
-from supabase import create_client, Client
-from typing import Optional, List
+import sys
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from uuid import UUID
+import asyncpg
+import msgspec
+import orjson
+import redis.asyncio as redis
+from fastapi import FastAPI, HTTPException, Header, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, List, Optional, Tuple
 
-# --- 1. Supabase and API Key Setup ---
+# --- 1. Database and API Key Setup ---
 # IMPORTANT: These secrets must be set in Vercel Environment Variables.
 
-# Supabase Keys (for database connection)
-SUPABASE_URL: Optional[str] = os.environ.get("SUPABASE_URL")
-SUPABASE_ANON_KEY: Optional[str] = os.environ.get("SUPABASE_ANON_KEY")
+@dataclass(slots=True, frozen=True)
+class _Config:
+    """
+    Environment settings, resolved once at import.
+    Unset variables are stored as empty strings.
+    """
+    # Supabase Postgres connection string (Project Settings -> Database -> Connection string)
+    supabase_db_url: str
+    # Custom API Key (for service access authentication)
+    api_access_key: str
+    # Optional Redis URL for a cache shared by every function instance
+    redis_url: str
+    # Vercel sets VERCEL_ENV; production deployments skip the interactive docs
+    # and OpenAPI schema generation to keep cold starts short.
+    is_production: bool
 
-# Custom API Key (for service access authentication)
-API_ACCESS_KEY: Optional[str] = os.environ.get("API_ACCESS_KEY")
+CFG = _Config(
+    supabase_db_url=os.environ.get("SUPABASE_DB_URL", ""),
+    api_access_key=os.environ.get("API_ACCESS_KEY", ""),
+    redis_url=os.environ.get("REDIS_URL", ""),
+    is_production=os.environ.get("VERCEL_ENV") == "production",
+)
 
-supabase: Optional[Client] = None
-keys_loaded: bool = False
+# Pre-encoded once so each request only does a constant-time bytes comparison
+_API_KEY_BYTES: bytes = CFG.api_access_key.encode("utf-8")
 
-# Initialize the Supabase Client if keys are available
-if SUPABASE_URL and SUPABASE_ANON_KEY:
-    try:
-        # Initialize client, which uses the PostgREST API under the hood
-        supabase = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
-        keys_loaded = True
-    except Exception as e:
-        # Log the failure but don't crash the serverless function cold start
-        print(f"Failed to create Supabase client during startup: {e}")
-        supabase = None
+# The asyncpg pool talks to Postgres directly, skipping the PostgREST HTTP hop.
+# It is created lazily by get_pool() on the first request that needs it.
+pool: Optional[asyncpg.Pool] = None
+_pool_lock = asyncio.Lock()
+# Bumped on every creation attempt so requests queued behind a failed attempt
+# reuse its outcome instead of each retrying with a fresh connect timeout
+_pool_attempts: int = 0
+keys_loaded: bool = bool(CFG.supabase_db_url)
+
+# The healthcheck body never changes after import, so it is encoded only once
+_HEALTH_BYTES: bytes = orjson.dumps({
+    "status": "ok",
+    "service": "Knowsta Chat Python API",
+    "supabase_keys_loaded": keys_loaded
+})
+
+# Acknowledgement body for inserts that don't return the stored row
+_SUCCESS_BYTES: bytes = orjson.dumps({"success": True})
 
 # --- 2. FastAPI Setup and Data Model ---
-app = FastAPI(title="Knowsta Chat API")
+async def close_clients():
+    """
+    Closes the shared Postgres connection pool and the Redis client.
+    """
+    if pool:
+        await pool.close()
+    if redis_client:
+        await redis_client.aclose()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Nothing is opened at startup (see get_pool()); clients are closed on shutdown.
+    """
+    yield
+    await close_clients()
+
+# Every route returns a pre-encoded Response, so no default response class
+# is set; docs are disabled in production (see _Config.is_production).
+# Route names are already unique, so they double as operation ids.
+app = FastAPI(
+    title="Knowsta Chat API",
+    lifespan=lifespan,
+    docs_url=None if CFG.is_production else "/docs",
+    redoc_url=None if CFG.is_production else "/redoc",
+    openapi_url=None if CFG.is_production else "/openapi.json",
+    generate_unique_id_function=lambda route: route.name,
+)
 
-# Pydantic Model for a new message (used for input validation)
-class Message(BaseModel):
+async def get_pool() -> Optional[asyncpg.Pool]:
+    """
+    Returns the shared Postgres connection pool, creating it on first use.
+    Cold starts that only serve the healthcheck never open a connection.
+    A failed attempt is logged and retried by the next request that arrives
+    after it; requests that were already waiting on it share its failure.
+    """
+    global pool, _pool_attempts
+    if pool is None and CFG.supabase_db_url:
+        attempt = _pool_attempts
+        async with _pool_lock:
+            # Another request may have created the pool, or just failed to,
+            # while we waited
+            if pool is None and attempt == _pool_attempts:
+                _pool_attempts += 1
+                try:
+                    pool = await asyncpg.create_pool(
+                        dsn=CFG.supabase_db_url,
+                        min_size=2,
+                        max_size=10,
+                        statement_cache_size=1024,
+                        # Fail fast rather than hanging the function on a stalled database
+                        timeout=5.0,
+                        command_timeout=5.0,
+                    )
+                except Exception as e:
+                    # Log the failure but let the caller report a database error
+                    print(f"Failed to create database pool: {e}")
+                    pool = None
+    return pool
+
+# msgspec Struct for a new message (used for input validation).
+# Both message Structs only hold scalar fields and can never form reference
+# cycles, so gc=False skips garbage-collector tracking for every instance.
+class Message(msgspec.Struct, frozen=True, gc=False):
     user_id: str
     content: str
 
-# Pydantic Model for the response data structure
-class MessageResponse(BaseModel):
-    id: str
+# msgspec Struct for the response data structure (built from trusted rows, not validated)
+class MessageResponse(msgspec.Struct, frozen=True, gc=False):
+    id: UUID
     user_id: str
     content: str
-    created_at: str
+    created_at: datetime
+
+# Decoders and the encoder are built once so the per-type schema is compiled
+# at import instead of being looked up on every request
+_message_decoder = msgspec.json.Decoder(Message)
+_bulk_decoder = msgspec.json.Decoder(List[Message])
+_encoder = msgspec.json.Encoder()
+
+# Larger batches would risk running into command_timeout inside one transaction
+MAX_BULK_SIZE: int = 500
+
+# Routes read the raw body instead of declaring a model parameter, so the
+# request schema is generated from the Struct and attached via openapi_extra
+_MESSAGE_SCHEMA: dict = msgspec.json.schema_components([Message])[1]["Message"]
+
+def json_body_openapi(schema: dict) -> dict:
+    """
+    Builds the 'openapi_extra' entry documenting a required JSON request body.
+    """
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": schema}},
+        }
+    }
+
+def json_response_bytes(body: bytes) -> Response:
+    """
+    Wraps an already encoded JSON body in a response.
+    """
+    return Response(content=body, media_type="application/json")
+
+def json_response(data) -> Response:
+    """
+    Encodes a message payload with msgspec and wraps it in a JSON response.
+    """
+    return json_response_bytes(_encoder.encode(data))
+
+# --- Message Cache ---
+# Polling clients ask for the same latest-50 window repeatedly, so the last
+# result is kept for a short TTL. The lock coalesces concurrent misses into a
+# single database fetch, and the generation counter stops a fetch that raced
+# with an insert from caching pre-insert data. The encoded JSON body is cached
+# so hits skip serialization as well.
+CACHE_TTL: float = 1.0
+MESSAGES_PAGE_SIZE: int = 50
+MAX_HISTORY_LIMIT: int = 1000
+_cache: Optional[Tuple[float, bytes]] = None
+_cache_generation: int = 0
+_cache_lock = asyncio.Lock()
+
+# When REDIS_URL is set, the encoded body is also shared through Redis so
+# reads are collapsed across all function instances and survive cold starts.
+# from_url() does not connect until the first command is sent. Short socket
+# timeouts keep a hung Redis from stalling reads under _cache_lock or writes
+# that have already committed.
+REDIS_CACHE_KEY: str = "messages:latest50"
+REDIS_CACHE_TTL: int = 2
+redis_client: Optional[redis.Redis] = None
+if CFG.redis_url:
+    try:
+        redis_client = redis.from_url(
+            CFG.redis_url,
+            decode_responses=False,
+            max_connections=20,
+            socket_connect_timeout=0.5,
+            socket_timeout=0.5,
+        )
+    except Exception as e:
+        # A malformed REDIS_URL only disables the shared cache
+        print(f"Failed to configure Redis client: {e}")
+
+async def invalidate_message_cache():
+    """
+    Drops the cached message list after a write.
+    """
+    global _cache, _cache_generation
+    _cache = None
+    _cache_generation += 1
+    if redis_client:
+        try:
+            await redis_client.delete(REDIS_CACHE_KEY)
+        except Exception as e:
+            # A stale shared cache expires on its own within REDIS_CACHE_TTL
+            print(f"Failed to invalidate Redis message cache: {e}")
 
 # --- API Key Authentication Dependency ---
-def verify_api_key(x_api_key: Optional[str] = Header(None, alias="X-API-KEY")):
+async def verify_api_key(x_api_key: Optional[str] = Header(None, alias="X-API-KEY")):
     """
     Dependency that checks the 'X-API-KEY' header against the secret key.
+    Declared async because it never blocks; FastAPI would otherwise dispatch
+    it to the threadpool on every request.
     """
-    # Keys must be loaded AND the submitted key must match the secret
-    if not keys_loaded or x_api_key is None or x_api_key != API_ACCESS_KEY:
+    # Keys must be loaded AND the submitted key must match the secret.
+    # compare_digest avoids leaking how many leading characters matched.
+    if (
+        not keys_loaded
+        or not _API_KEY_BYTES
+        or x_api_key is None
+        or not hmac.compare_digest(x_api_key.encode("utf-8"), _API_KEY_BYTES)
+    ):
         # If the key is missing or incorrect, deny access
         raise HTTPException(
             status_code=401, 
@@ -60,68 +247,306 @@ def verify_api_key(x_api_key: Optional[str] = Header(None, alias="X-API-KEY")):
 # --- 3. API Routes (Protected by API Key) ---
 
 @app.get("/", tags=["Healthcheck"])
-def root():
+async def root():
     """
     Simple health check endpoint to verify the API is running and check key status.
     If 'supabase_keys_loaded' is false, you must check your Vercel Environment Variables.
     """
-    return {
-        "status": "ok", 
-        "service": "Knowsta Chat Python API",
-        "supabase_keys_loaded": keys_loaded
-    }
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
 
-@app.post("/messages", response_model=MessageResponse, tags=["Messages"])
-def send_message(
-    message: Message, 
+@app.post("/messages", tags=["Messages"], openapi_extra=json_body_openapi(_MESSAGE_SCHEMA))
+async def send_message(
+    request: Request, 
+    minimal: bool = False,
     authenticated_key: str = Depends(verify_api_key) # API Key Protection
 ):
     """
     Endpoint to insert a new message into the Supabase 'messages' table.
+    The body is decoded straight from bytes with msgspec.
+    Pass '?minimal=true' to skip returning the inserted row and receive
+    only '{"success": true}' as acknowledgement.
     """
-    if not supabase:
+    # Malformed bodies are rejected before waiting on the database
+    try:
+        message = _message_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        # ValidationError is a subclass, so this covers bad JSON and bad fields
+        raise HTTPException(status_code=422, detail=f"Invalid message body: {e}")
+
+    pool = await get_pool()
+    if not pool:
         raise HTTPException(status_code=500, detail="Database connection error. Check Vercel logs for key errors.")
         
     try:
-        # Insert data into the 'messages' table, relying on Supabase/Postgres 
+        # Insert data into the 'messages' table, relying on Postgres 
         # to auto-generate 'id' and 'created_at'
-        result = supabase.table('messages').insert({
-            "user_id": message.user_id,
-            "content": message.content,
-        }).execute()
-
-        # result.data will contain the successfully inserted record(s)
-        # We assume one record is inserted
-        if result.data and isinstance(result.data, list) and len(result.data) > 0:
-            return result.data[0]
+        if minimal:
+            # No RETURNING clause: Postgres sends back only the command status
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    "INSERT INTO messages(user_id, content) VALUES($1, $2)",
+                    message.user_id,
+                    message.content,
+                )
+            await invalidate_message_cache()
+            return json_response_bytes(_SUCCESS_BYTES)
+
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "INSERT INTO messages(user_id, content) VALUES($1, $2) "
+                "RETURNING id, user_id, content, created_at",
+                message.user_id,
+                message.content,
+            )
+
+        # RETURNING yields exactly one row for a successful insert.
+        # Data originates from trusted Postgres; validation is skipped.
+        if row is not None:
+            await invalidate_message_cache()
+            return json_response(MessageResponse(**row))
         else:
-             raise Exception("Supabase insert returned no data.")
+             raise Exception("Postgres insert returned no data.")
 
     except Exception as e:
         print(f"Error inserting message: {e}")
         raise HTTPException(status_code=500, detail="Failed to insert message into database.")
 
-@app.get("/messages", response_model=List[MessageResponse], tags=["Messages"])
-def get_messages(
+@app.post(
+    "/messages/bulk",
+    tags=["Messages"],
+    openapi_extra=json_body_openapi(
+        {"type": "array", "items": _MESSAGE_SCHEMA, "maxItems": MAX_BULK_SIZE}
+    ),
+)
+async def send_messages_bulk(
+    request: Request, 
     authenticated_key: str = Depends(verify_api_key) # API Key Protection
 ):
     """
-    Endpoint to retrieve the latest 50 messages from the 'messages' table.
+    Endpoint to insert a batch of messages (a JSON array of message objects)
+    in a single transaction. Returns the number of inserted messages.
+    Batches are limited to MAX_BULK_SIZE messages.
     """
-    if not supabase:
+    # Malformed bodies are rejected before waiting on the database
+    try:
+        messages = _bulk_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        # ValidationError is a subclass, so this covers bad JSON and bad fields
+        raise HTTPException(status_code=422, detail=f"Invalid message body: {e}")
+
+    if len(messages) > MAX_BULK_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many messages: at most {MAX_BULK_SIZE} are accepted per batch."
+        )
+
+    pool = await get_pool()
+    if not pool:
         raise HTTPException(status_code=500, detail="Database connection error. Check Vercel logs for key errors.")
-        
+
+    if not messages:
+        return json_response({"count": 0})
+
     try:
-        # Query the 'messages' table, order by creation time descending (latest first)
-        # and limit the results to 50
-        result = supabase.table('messages').select("*").order("created_at", desc=True).limit(50).execute()
-        
-        # result.data contains the fetched messages
-        messages = result.data
+        # executemany pipelines every row over one connection without waiting
+        # for each INSERT to complete, so the batch costs about one round-trip
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(
+                    "INSERT INTO messages(user_id, content) VALUES($1, $2)",
+                    [(m.user_id, m.content) for m in messages],
+                )
+
+    except Exception as e:
+        print(f"Error inserting messages: {e}")
+        raise HTTPException(status_code=500, detail="Failed to insert messages into database.")
+
+    await invalidate_message_cache()
+    return json_response({"count": len(messages)})
 
-        # We reverse the order to display oldest first, as is standard in chat logs.
-        return messages[::-1] 
+# Ordered like get_messages: latest rows first inside, chronological outside
+_HISTORY_QUERY: str = (
+    "SELECT * FROM ("
+    "SELECT id, user_id, content, created_at FROM messages "
+    "ORDER BY created_at DESC LIMIT $1"
+    ") latest ORDER BY created_at ASC"
+)
+
+# Rows fetched from the server-side cursor per round-trip
+STREAM_BATCH_SIZE: int = 50
+
+class CursorStreamingResponse(StreamingResponse):
+    """
+    Streaming response that owns the connection its cursor runs on.
+    The transaction is rolled back and the connection released once the
+    response ends, even if the client disconnected before the body started.
+    """
+    def __init__(
+        self,
+        content: AsyncIterator[bytes],
+        pool: asyncpg.Pool,
+        conn: asyncpg.Connection,
+        transaction: asyncpg.transaction.Transaction,
+        **kwargs,
+    ):
+        super().__init__(content, **kwargs)
+        self.pool = pool
+        self.conn = conn
+        self.transaction = transaction
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await release_cursor_connection(self.pool, self.conn, self.transaction)
+
+async def release_cursor_connection(
+    pool: asyncpg.Pool, conn: asyncpg.Connection, transaction: asyncpg.transaction.Transaction
+):
+    """
+    Ends the read-only cursor transaction and returns its connection to the pool.
+    """
+    try:
+        await transaction.rollback()
+    except Exception as e:
+        # The connection is still released; the pool resets or discards it
+        print(f"Failed to close message cursor transaction: {e}")
+    finally:
+        await pool.release(conn)
 
+async def stream_messages(cursor: asyncpg.cursor.Cursor) -> AsyncIterator[bytes]:
+    """
+    Yields the rows of an already opened cursor as a JSON array, batch by
+    batch, so memory stays flat and the first bytes go out with the first rows.
+    """
+    try:
+        yield b"["
+        first = True
+        while rows := await cursor.fetch(STREAM_BATCH_SIZE):
+            for row in rows:
+                prefix = b"" if first else b","
+                yield prefix + _encoder.encode(MessageResponse(**row))
+                first = False
+        yield b"]"
     except Exception as e:
-        print(f"Error fetching messages: {e}")
-        raise HTTPException(status_code=500, detail="Failed to retrieve messages from database.")
+        # Headers are already sent; re-raising makes the server abort the
+        # body rather than close a well-formed but incomplete array
+        print(f"Error streaming messages: {e}")
+        raise
+
+@app.get("/messages", tags=["Messages"])
+async def get_messages(
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MAX_HISTORY_LIMIT),
+    authenticated_key: str = Depends(verify_api_key) # API Key Protection
+):
+    """
+    Endpoint to retrieve the latest 50 messages from the 'messages' table.
+    Pass '?limit=N' (up to 1000) for a different window; those responses
+    are not cached, and histories longer than 50 are streamed row by row.
+    """
+    global _cache
+
+    pool = await get_pool()
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection error. Check Vercel logs for key errors.")
+
+    if limit < MESSAGES_PAGE_SIZE:
+        # A short window fits in one fetch; a cursor would only add round-trips
+        try:
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(_HISTORY_QUERY, limit)
+            return json_response([MessageResponse(**r) for r in rows])
+        except Exception as e:
+            print(f"Error fetching messages: {e}")
+            raise HTTPException(status_code=500, detail="Failed to retrieve messages from database.")
+
+    if limit > MESSAGES_PAGE_SIZE:
+        # Open the cursor before the response starts so connection and query
+        # failures still surface as a 500 instead of a truncated 200
+        conn = transaction = None
+        try:
+            conn = await pool.acquire()
+            # Server-side cursors only exist inside a transaction
+            started = conn.transaction()
+            await started.start()
+            transaction = started
+            cursor = await conn.cursor(_HISTORY_QUERY, limit)
+        except Exception as e:
+            if transaction is not None:
+                await release_cursor_connection(pool, conn, transaction)
+            elif conn is not None:
+                await pool.release(conn)
+            print(f"Error fetching messages: {e}")
+            raise HTTPException(status_code=500, detail="Failed to retrieve messages from database.")
+        # The response owns the connection from here on
+        return CursorStreamingResponse(
+            stream_messages(cursor), pool, conn, transaction, media_type="application/json"
+        )
+        
+    # Serve from the cache while it is fresh
+    now = time.monotonic()
+    if _cache and now - _cache[0] < CACHE_TTL:
+        return json_response_bytes(_cache[1])
+
+    async with _cache_lock:
+        # Another request may have refreshed the cache while we waited
+        now = time.monotonic()
+        if _cache and now - _cache[0] < CACHE_TTL:
+            return json_response_bytes(_cache[1])
+        generation = _cache_generation
+
+        # Fall back to the shared cache before touching the database
+        if redis_client:
+            try:
+                cached = await redis_client.get(REDIS_CACHE_KEY)
+            except Exception as e:
+                print(f"Failed to read Redis message cache: {e}")
+                cached = None
+            if cached:
+                # Same race as the database path: don't keep a body read
+                # before a local insert landed
+                if generation == _cache_generation:
+                    _cache = (now, cached)
+                return json_response_bytes(cached)
+
+        try:
+            # The inner query picks the latest 50 messages (newest first); the outer
+            # query puts them back in chronological order, as is standard in chat logs,
+            # so no reversal is needed in Python.
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(_HISTORY_QUERY, MESSAGES_PAGE_SIZE)
+            
+            # Data originates from trusted Postgres; Struct construction
+            # does not validate, and msgspec encodes the list in one pass.
+            body = _encoder.encode([MessageResponse(**r) for r in rows])
+
+        except Exception as e:
+            print(f"Error fetching messages: {e}")
+            raise HTTPException(status_code=500, detail="Failed to retrieve messages from database.")
+
+        # Skip caching if a message was inserted while we were fetching
+        if generation == _cache_generation:
+            _cache = (now, body)
+            if redis_client:
+                try:
+                    await redis_client.setex(REDIS_CACHE_KEY, REDIS_CACHE_TTL, body)
+                except Exception as e:
+                    print(f"Failed to write Redis message cache: {e}")
+        return json_response_bytes(body)
+
+# --- 4. Local Runner ---
+# Vercel imports 'app' directly; this block only runs for local `python api/index.py`.
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "api.index:app",
+        # Make 'api.index' importable regardless of the working directory
+        app_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        # uvloop is not available on Windows; fall back to the default loop there
+        loop="uvloop" if sys.platform != "win32" else "auto",
+        http="httptools",
+    )
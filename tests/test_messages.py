@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+import api.index as index
+
+
+class FakeTransaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def start(self):
+        self.conn.in_transaction = True
+
+    async def rollback(self):
+        self.conn.in_transaction = False
+        self.conn.rollbacks += 1
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    async def fetch(self, n):
+        batch, self.rows = self.rows[:n], self.rows[n:]
+        return batch
+
+
+class FakeConnection:
+    def __init__(self):
+        self.in_transaction = False
+        self.rollbacks = 0
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    async def cursor(self, query, limit):
+        return FakeCursor([])
+
+
+class FakePool:
+    def __init__(self):
+        self.acquired = 0
+        self.released = []
+
+    async def acquire(self):
+        self.acquired += 1
+        return FakeConnection()
+
+    async def release(self, conn):
+        self.released.append(conn)
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    fake = FakePool()
+    monkeypatch.setattr(index, "pool", fake)
+    monkeypatch.setattr(index, "keys_loaded", True)
+    monkeypatch.setattr(index, "_API_KEY_BYTES", b"test-key")
+    return fake
+
+
+def history_scope(limit):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/messages",
+        "raw_path": b"/messages",
+        "query_string": f"limit={limit}".encode(),
+        "root_path": "",
+        "headers": [(b"x-api-key", b"test-key")],
+        "client": ("testclient", 50000),
+        "server": ("testserver", 80),
+    }
+
+
+async def call_app(scope, send):
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    try:
+        await index.app(scope, receive, send)
+    except Exception:
+        pass
+
+
+def test_streamed_history_releases_connection_on_early_disconnect(fake_pool):
+    async def send(message):
+        # The client is gone before the response starts
+        if message["type"] == "http.response.start":
+            raise OSError("client disconnected")
+
+    async def run():
+        for _ in range(3):
+            await call_app(history_scope(200), send)
+
+    asyncio.run(run())
+
+    assert fake_pool.acquired == 3
+    assert len(fake_pool.released) == 3
+    assert all(c.rollbacks == 1 and not c.in_transaction for c in fake_pool.released)
+
+
+def test_streamed_history_rolls_back_after_full_response(fake_pool):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(call_app(history_scope(200), send))
+
+    body = b"".join(m.get("body", b"") for m in messages if m["type"] == "http.response.body")
+    assert messages[0]["status"] == 200
+    assert body == b"[]"
+    assert len(fake_pool.released) == 1
+    assert fake_pool.released[0].rollbacks == 1
+
+
+def test_short_history_skips_the_cursor(fake_pool, monkeypatch):
+    fetched = []
+
+    class ShortConnection(FakeConnection):
+        async def fetch(self, query, limit):
+            fetched.append(limit)
+            return []
+
+        async def cursor(self, query, limit):
+            raise AssertionError("short windows should not open a cursor")
+
+    class ShortPool(FakePool):
+        def acquire(self):
+            pool = self
+
+            class Acquire:
+                async def __aenter__(self):
+                    pool.acquired += 1
+                    return ShortConnection()
+
+                async def __aexit__(self, *exc):
+                    pool.released.append(None)
+
+            return Acquire()
+
+    short_pool = ShortPool()
+    monkeypatch.setattr(index, "pool", short_pool)
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(call_app(history_scope(10), send))
+
+    assert messages[0]["status"] == 200
+    assert fetched == [10]
+    assert short_pool.acquired == len(short_pool.released) == 1